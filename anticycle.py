@@ -1,23 +1,39 @@
-from decimal import Decimal
-from collections import defaultdict
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import os
+import queue
+import threading
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 import struct
 import sys
 import zmq
 
+try:
+    # C-accelerated JSON parsing; getrawtransaction-sized responses
+    # are noticeably cheaper to decode than with the stdlib parser
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 rpc_user = os.environ.get('RPCUSER')
 rpc_password = os.environ.get('RPCPASS')
 rpc_host = '127.0.0.1'
 rpc_port = 8332
 
-if len(sys.argv) != 2:
-    raise Exception("Must pass in number of MB for transaction cache")
-
-num_MB = int(sys.argv[1])
+if len(sys.argv) == 2:
+    num_MB = int(sys.argv[1])
+elif os.environ.get('ANTICYCLE_CACHE_MB'):
+    num_MB = int(os.environ['ANTICYCLE_CACHE_MB'])
+else:
+    raise Exception("Must pass in number of MB for transaction cache (or set ANTICYCLE_CACHE_MB)")
 
 if not rpc_user:
     raise Exception("Must set RPCUSER env variable to connect to Bitcoin Core RPC")
@@ -25,6 +41,26 @@ if not rpc_user:
 if not rpc_password:
     raise Exception("Must set RPCPASS env variable to connect to Bitcoin Core RPC")
 
+# URLs for the RPC and REST endpoints
+RPC_URL = f'http://{rpc_host}:{rpc_port}'
+REST_TX_URL = f'{RPC_URL}/rest/tx/'
+
+# Pre-serialized JSON-RPC payload templates; only the parameter is
+# spliced in per call instead of building a dict and json.dumps-ing
+# it on every ZMQ event
+GETMEMPOOLENTRY_PREFIX = b'{"jsonrpc":"1.0","id":"anticycle","method":"getmempoolentry","params":["'
+SENDRAWTRANSACTION_PREFIX = b'{"jsonrpc":"1.0","id":"anticycle","method":"sendrawtransaction","params":["'
+ESTIMATESMARTFEE_PREFIX = b'{"jsonrpc":"1.0","id":"anticycle","method":"estimatesmartfee","params":['
+STRING_PARAM_SUFFIX = b'"]}'
+INT_PARAM_SUFFIX = b']}'
+
+# Single keep-alive session for all RPC calls so we aren't
+# paying TCP setup + auth on every request
+SESSION = requests.Session()
+SESSION.auth = HTTPBasicAuth(rpc_user, rpc_password)
+SESSION.headers.update({'Content-Type': 'application/json'})
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
 # Configure logging settings
 logging.basicConfig(
     stream=sys.stdout,
@@ -33,133 +69,226 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# Bound once; used to skip argument construction (txid hexing and
+# friends) for per-event log lines when INFO is disabled
+LOGGER = logging.getLogger()
+
 # How many times a utxo has to go from Top->Bottom to be
 # have its spending tx cached(if otherwise empty)
 # Increasing this value reducs false positive rates
 # and reduces memory usage accordingly.
 CYCLE_THRESH = 1
 
-def getrawtransaction(txid):
-    # Create the RPC request payload
-    payload = json.dumps({
-        "jsonrpc": "1.0",
-        "id": "anticycle",
-        "method": "getrawtransaction",
-        "params": [txid, 1]
-    })
-
-    # Set the headers for the request
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    # Create the URL for the RPC endpoint
-    url = f'http://{rpc_host}:{rpc_port}'
-
-    # Send the RPC request
-    response = requests.post(url, headers=headers, data=payload, auth=HTTPBasicAuth(rpc_user, rpc_password))
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the JSON response
-        result = response.json()
-        return result["result"]
+# Label bytes of the zmqpubsequence stream
+LABEL_ADD = ord('A')
+LABEL_REMOVE = ord('R')
+LABEL_CONNECT = ord('C')
+LABEL_DISCONNECT = ord('D')
+
+# Upper bound on tracked per-utxo cycle counters; beyond this the
+# stalest counters are forgotten rather than growing for the life
+# of the process.
+MAX_CYCLE_ENTRIES = 100000
+
+# Workers for the RPC fetch pool. The work is pure HTTP wait against
+# a single local bitcoind, so this bounds in-flight RPCs, not CPU.
+RPC_POOL_WORKERS = 8
+
+def read_compact_size(buf, offset):
+    # Bitcoin CompactSize decoding, returns (value, new_offset)
+    first = buf[offset]
+    if first < 253:
+        return first, offset + 1
+    elif first == 253:
+        return struct.unpack_from('<H', buf, offset + 1)[0], offset + 3
+    elif first == 254:
+        return struct.unpack_from('<I', buf, offset + 1)[0], offset + 5
     else:
-        logging.info(f'Error: {response.status_code}')
-        logging.info(response.text)
-        return None
-
-def estimatesmartfee(block_count):
-    # Create the RPC request payload
-    payload = json.dumps({
-        "jsonrpc": "1.0",
-        "id": "anticycle",
-        "method": "estimatesmartfee",
-        "params": [block_count]
-    })
+        return struct.unpack_from('<Q', buf, offset + 1)[0], offset + 9
+
+def parse_tx_inputs(buf):
+    # Pull prevouts straight out of the consensus serialization:
+    # version, optional segwit marker/flag, inputs. Each prevout is
+    # kept as the raw 36-byte prevhash+vout slice, which is a single
+    # contiguous dict/set key that hashes in one pass instead of a
+    # (hex_str, int) tuple.
+    offset = 4
+    if buf[offset] == 0:
+        # Segwit marker + flag
+        offset += 2
+    num_inputs, offset = read_compact_size(buf, offset)
+    prevouts = []
+    for _ in range(num_inputs):
+        # prevhash (internal byte order) + vout, already adjacent
+        prevouts.append(bytes(buf[offset:offset + 36]))
+        offset += 36
+        # Skip scriptSig and nSequence
+        script_len, offset = read_compact_size(buf, offset)
+        offset += script_len + 4
+    return tuple(prevouts)
+
+def prevout_str(prevout):
+    # Render a raw 36-byte prevout as txid:vout for logging
+    return f"{prevout[:32][::-1].hex()}:{struct.unpack_from('<I', prevout, 32)[0]}"
 
-    # Set the headers for the request
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    # Create the URL for the RPC endpoint
-    url = f'http://{rpc_host}:{rpc_port}'
-
-    # Send the RPC request
-    response = requests.post(url, headers=headers, data=payload, auth=HTTPBasicAuth(rpc_user, rpc_password))
+def getrawtransaction(txid):
+    # Fetch the raw tx over the REST interface (requires -rest) as
+    # binary; avoids bitcoind JSON-encoding the full decoded tx just
+    # so we can read the inputs back out of it.
+    response = SESSION.get(REST_TX_URL + txid + '.bin')
 
     # Check if the request was successful
     if response.status_code == 200:
-        # Parse the JSON response
-        result = response.json()
-        return result["result"]
+        tx_bytes = response.content
+        return TxEntry(tx_bytes, parse_tx_inputs(tx_bytes))
     else:
-        logging.info(f'Error: {response.status_code}')
+        logging.info('Error: %s', response.status_code)
         logging.info(response.text)
         return None
 
-def getmempoolentry(txid):
-    # Create the RPC request payload
-    payload = json.dumps({
-        "jsonrpc": "1.0",
-        "id": "anticycle",
-        "method": "getmempoolentry",
-        "params": [txid]
-    })
-
-    # Set the headers for the request
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    # Create the URL for the RPC endpoint
-    url = f'http://{rpc_host}:{rpc_port}'
-
-    # Send the RPC request
-    response = requests.post(url, headers=headers, data=payload, auth=HTTPBasicAuth(rpc_user, rpc_password))
-
-    # Check if the request was successful
+def get_topblock_rate_sat_kvb(fallback=None):
+    # Top-block fee threshold from the local node only, as an integer
+    # sat/kvB. Returns fallback when the estimator has no answer
+    # (startup, error) so a flaky estimate never clears the threshold.
+    result = estimatesmartfee(3)
+    if result is None or "feerate" not in result:
+        return fallback
+    return round(result["feerate"] * 100_000_000)
+
+def zmq_reader(socket, msg_queue):
+    # Dedicated reader thread: keeps the SUB socket drained no matter
+    # how long the main thread spends on RPC-bound processing, so ZMQ
+    # never has a reason to drop notifications.
+    while True:
+        try:
+            msg_queue.put(socket.recv_multipart())
+        except zmq.ZMQError:
+            # Socket closed on shutdown
+            break
+
+def _rpc_post(payload):
+    # Shared POST + response handling for the JSON-RPC helpers; the
+    # session, URL and auth are all preconstructed at import time
+    response = SESSION.post(RPC_URL, data=payload)
     if response.status_code == 200:
-        # Parse the JSON response
-        result = response.json()
-        return result["result"]
-    else:
-        logging.info(f'Error: {response.status_code}')
-        logging.info(response.text)
-        return None
-
-def sendrawtransaction(txid):
-    # Create the RPC request payload
-    payload = json.dumps({
-        "jsonrpc": "1.0",
-        "id": "anticycle",
-        "method": "sendrawtransaction",
-        "params": [txid]
-    })
-
-    # Set the headers for the request
-    headers = {
-        'Content-Type': 'application/json'
-    }
+        return json_loads(response.content)
+    logging.info('Error: %s', response.status_code)
+    logging.info(response.text)
+    return None
 
-    # Create the URL for the RPC endpoint
-    url = f'http://{rpc_host}:{rpc_port}'
-
-    # Send the RPC request
-    response = requests.post(url, headers=headers, data=payload, auth=HTTPBasicAuth(rpc_user, rpc_password))
+def estimatesmartfee(block_count):
+    result = _rpc_post(ESTIMATESMARTFEE_PREFIX + str(block_count).encode() + INT_PARAM_SUFFIX)
+    return result["result"] if result is not None else None
 
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the JSON response
-        result = response.json()
-        return result["result"]
-    else:
-        # FIXME: return error, delete tx
-        # if inputs missing
-        logging.info(f'Error: {response.status_code}')
-        logging.info(response.text)
-        return None
+def getmempoolentry(txid):
+    result = _rpc_post(GETMEMPOOLENTRY_PREFIX + txid.encode() + STRING_PARAM_SUFFIX)
+    return result["result"] if result is not None else None
+
+def sendrawtransaction(tx_hex):
+    # FIXME: return error, delete tx
+    # if inputs missing
+    result = _rpc_post(SENDRAWTRANSACTION_PREFIX + tx_hex.encode() + STRING_PARAM_SUFFIX)
+    return result["result"] if result is not None else None
+
+class TxEntry:
+    # Compact cache entry: only what the state machine ever reads
+    # back, with the byte size precomputed for the LRU accounting
+    __slots__ = ("tx_bytes", "prevouts", "size")
+
+    def __init__(self, tx_bytes, prevouts):
+        self.tx_bytes = tx_bytes
+        self.prevouts = prevouts
+        self.size = len(tx_bytes)
+
+class CycleCounter(OrderedDict):
+    # Size-bounded utxo -> count map. Incrementing marks the utxo as
+    # recently cycled; at capacity the least-recently-cycled utxo is
+    # dropped, so memory stays bounded regardless of uptime.
+    def __init__(self, max_entries):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def increment(self, key):
+        count = self.get(key, 0) + 1
+        self[key] = count
+        self.move_to_end(key)
+        if len(self) > self.max_entries:
+            self.popitem(last=False)
+        return count
+
+    def get_count(self, key):
+        return self.get(key, 0)
+
+# Rough Python-side cost of keeping one tx cached (key, TxEntry,
+# prevout objects, dict slot), counted against the byte budget so an
+# attacker streaming many tiny txs can't blow past the nominal cap
+ENTRY_OVERHEAD_BYTES = 200
+
+class ByteLRU(OrderedDict):
+    # Byte-budgeted LRU mapping txid -> TxEntry.
+    # Oldest entries are evicted one at a time as inserts push the
+    # total over budget, instead of wiping all state at once. An
+    # optional on_evict callback lets dependent indexes be purged
+    # alongside the evicted entry.
+    def __init__(self, max_bytes, on_evict=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.on_evict = on_evict
+
+    def touch(self, key):
+        # Mark key as recently used
+        self.move_to_end(key)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.total_bytes -= super().__getitem__(key).size + ENTRY_OVERHEAD_BYTES
+        super().__setitem__(key, value)
+        self.total_bytes += value.size + ENTRY_OVERHEAD_BYTES
+        self.move_to_end(key)
+        while self.total_bytes > self.max_bytes:
+            evicted_key, evicted_value = self.popitem(last=False)
+            self.total_bytes -= evicted_value.size + ENTRY_OVERHEAD_BYTES
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted_value)
+
+    def __delitem__(self, key):
+        self.total_bytes -= super().__getitem__(key).size + ENTRY_OVERHEAD_BYTES
+        super().__delitem__(key)
+
+    def pop(self, key, default=None):
+        # Remove and return in one probe; dict.pop wouldn't route
+        # through our __delitem__ bookkeeping
+        entry = super().get(key)
+        if entry is None:
+            return default
+        self.total_bytes -= entry.size + ENTRY_OVERHEAD_BYTES
+        super().__delitem__(key)
+        return entry
+
+    def clear(self):
+        super().clear()
+        self.total_bytes = 0
+
+def rpc_batch(calls):
+    # Issue multiple RPCs in a single HTTP round-trip using
+    # JSON-RPC batching. calls is a list of (method, params);
+    # returns the result fields in the same order, None for
+    # any call that errored.
+    if not calls:
+        return []
+    payload = json_dumps([
+        {"jsonrpc": "1.0", "id": call_id, "method": method, "params": params}
+        for call_id, (method, params) in enumerate(calls)
+    ])
+    replies = _rpc_post(payload)
+
+    # Responses may come back in any order, match them up by id
+    results = [None] * len(calls)
+    if replies is not None:
+        for reply in replies:
+            results[reply["id"]] = reply["result"]
+    return results
 
 
 def main():
@@ -173,22 +302,28 @@ def main():
     
     # Create a socket of type SUBSCRIBE
     socket = context.socket(zmq.SUB)
-    
+
+    # Don't let ZMQ silently drop notifications if we fall behind;
+    # we'd rather buffer than diverge from the mempool
+    socket.setsockopt(zmq.RCVHWM, 0)
+
+    # Bigger kernel receive buffer to absorb block-tip bursts, and no
+    # lingering on shutdown
+    socket.setsockopt(zmq.RCVBUF, 4 * 1024 * 1024)
+    socket.setsockopt(zmq.LINGER, 0)
+
     # Connect to the publisher's socket
     port = "28332"  # specify the port you want to listen on
     socket.connect(f"tcp://localhost:{port}")
     
-    # Subscribe to all messages
-    # You can specify a prefix filter here to receive specific messages
-    socket.setsockopt_string(zmq.SUBSCRIBE, '')
+    # Only the sequence stream is interesting; filtering by prefix
+    # drops anything else before it reaches us
+    socket.setsockopt_string(zmq.SUBSCRIBE, 'sequence')
     
-    logging.info(f"Listening for messages on port {port}...")
+    logging.info("Listening for messages on port %s...", port)
 
-    # txid -> serialized_tx
-    # Cache for full transactions of which
-    # we believe are being replacement cycled.
-    cycled_tx_cache = {}
-    cycled_tx_cache_size = 0
+    # Simple anti-DoS max, enforced per cache by LRU eviction
+    tx_cache_max_byte_size = num_MB * 1000 * 1000
 
     # utxo
     # The complete set of inputs that are spent
@@ -198,19 +333,33 @@ def main():
     # a full "top block" slot each on inclusion.
     cycled_input_set = set([])
 
-    # txid -> serialize_tx
+    def on_cycled_evict(evicted_txid, evicted_tx):
+        # Purge the indexes that reference the evicted tx so the
+        # caches stay mutually consistent
+        for evicted_prevout in evicted_tx.prevouts:
+            if utxo_cache.get(evicted_prevout) == evicted_txid:
+                del utxo_cache[evicted_prevout]
+            cycled_input_set.discard(evicted_prevout)
+            utxo_cycled_count.pop(evicted_prevout, None)
+
+    # txid -> TxEntry
+    # Cache for full transactions of which
+    # we believe are being replacement cycled.
+    # Raw bytes only; hex is re-derived at resubmit time.
+    cycled_tx_cache = ByteLRU(tx_cache_max_byte_size, on_cycled_evict)
+
+    # txid -> TxEntry
     # This cache is for everything above "top block"
     # that we hear about. This cache is required only
     # because the R(emove) notification stream doesn't
     # give full transactions. We need them to compute
     # top->bottom utxo changes.
-    dummy_cache = {}
-    dummy_cache_size = 0
+    dummy_cache = ByteLRU(tx_cache_max_byte_size)
 
     # utxo -> int
     # How many times in this epoch has the specific utxo
     # gone from next block to non-next block?
-    utxo_cycled_count = defaultdict(int)
+    utxo_cycled_count = CycleCounter(MAX_CYCLE_ENTRIES)
 
     # utxo -> txid
     # Assign txids of protected transactions to utxos that
@@ -218,9 +367,6 @@ def main():
     # fetched from cycled_tx_cache.
     utxo_cache = {}
 
-    # Simple anti-DoS max
-    tx_cache_max_byte_size = num_MB * 1000 * 1000
-
     # These are populated by "R" events and cleared in
     # subsequent "A" events. These are to track
     # top->bottom transitions
@@ -229,24 +375,99 @@ def main():
 
     logging.info("Getting Top Block fee")
 
-    # "Top block" is considered next three blocks
-    topblock_rate_btc_kvb = estimatesmartfee(3)["feerate"]
+    # "Top block" is considered next three blocks.
+    # Kept as integer sat/kvB so the per-event feerate check is pure
+    # integer arithmetic.
+    topblock_rate_sat_kvb = get_topblock_rate_sat_kvb()
+    if topblock_rate_sat_kvb is None:
+        raise Exception("Could not fetch top block fee estimate from Bitcoin Core")
+
+    # In-flight out-of-band threshold refresh, if any; the result is
+    # folded in by the main thread between events
+    rate_future = None
+
+    # RPC work rides this pool so the ZMQ subscriber can be drained
+    # as fast as bitcoind publishes; all cache mutation stays on the
+    # main thread, in arrival order.
+    pool = ThreadPoolExecutor(max_workers=RPC_POOL_WORKERS)
+
+    # (received_seq, txid, label, future) in arrival order. future
+    # holds the in-flight RPC results for "A" events, None otherwise.
+    pending_events = deque()
+
+    # The reader thread owns the socket from here on; the main thread
+    # pulls messages off this queue instead of recv'ing directly
+    msg_queue = queue.Queue()
+    threading.Thread(target=zmq_reader, args=(socket, msg_queue), daemon=True).start()
 
     try:
         while True:
-            # Receive a message
-            topic, body, sequence = socket.recv_multipart()
-            received_seq = struct.unpack('<I', sequence)[-1]
-            txid = body[:32].hex()
-            label = chr(body[32])
-
-            if received_seq % 100 == 0:
-                logging.info(f"Transactions cached: {len(cycled_tx_cache)}, bytes cached: {cycled_tx_cache_size/1000000}/{num_MB}MB, topblock rate: {topblock_rate_btc_kvb}")
-                logging.info(f"Dummy cache: {len(dummy_cache)}, {dummy_cache_size/1000000}/{num_MB}MB")
-
-            if label == "A":
-                logging.info(f"Tx {txid} added")
-                entry = getmempoolentry(txid)
+            # Drain a bounded batch of buffered messages so all their
+            # mempool entry lookups can share one JSON-RPC round-trip
+            msgs = []
+            while len(msgs) < 64:
+                try:
+                    if pending_events or msgs:
+                        msgs.append(msg_queue.get_nowait())
+                    else:
+                        msgs.append(msg_queue.get())
+                except queue.Empty:
+                    break
+
+            entry_calls = []
+            parsed = []
+            for topic, body, sequence in msgs:
+                received_seq = struct.unpack('<I', sequence)[-1]
+                # Keep the txid as raw bytes; it's only a dict key
+                # internally and hashes faster than the hex string
+                txid = bytes(body[:32])
+                # The label byte is compared as an int; no chr() string
+                # construction per message
+                label = body[32]
+                entry_index = None
+                raw_future = None
+                if label == LABEL_ADD:
+                    # One shared batch for the entries; raw txs come
+                    # over REST so those stay parallel on the pool.
+                    # The RPC interface wants the hex form.
+                    txid_hex = txid.hex()
+                    entry_index = len(entry_calls)
+                    entry_calls.append(("getmempoolentry", [txid_hex]))
+                    raw_future = pool.submit(getrawtransaction, txid_hex)
+                parsed.append((received_seq, txid, label, entry_index, raw_future))
+
+            # Fire the combined entry batch for this drain, then queue
+            # the events for in-order processing
+            entry_future = pool.submit(rpc_batch, entry_calls) if entry_calls else None
+            for received_seq, txid, label, entry_index, raw_future in parsed:
+                future = None
+                if entry_index is not None:
+                    future = (entry_future, entry_index, raw_future)
+                pending_events.append((received_seq, txid, label, future))
+
+            # Apply one event's state updates, in arrival order
+            received_seq, txid, label, future = pending_events.popleft()
+
+            # Fold in a completed fee-threshold refresh without ever
+            # blocking event processing on the estimator
+            if rate_future is not None and rate_future.done():
+                topblock_rate_sat_kvb = rate_future.result()
+                rate_future = None
+
+            if received_seq % 100 == 0 and LOGGER.isEnabledFor(logging.INFO):
+                logging.info("Transactions cached: %s, bytes cached: %s/%sMB, topblock rate: %ssat/kvB",
+                             len(cycled_tx_cache), cycled_tx_cache.total_bytes/1000000, num_MB, topblock_rate_sat_kvb)
+                logging.info("Dummy cache: %s, %s/%sMB",
+                             len(dummy_cache), dummy_cache.total_bytes/1000000, num_MB)
+
+            if label == LABEL_ADD:
+                if LOGGER.isEnabledFor(logging.INFO):
+                    logging.info("Tx %s added", txid.hex())
+                # The getmempoolentry/getrawtransaction fetches were
+                # kicked off when the message arrived; collect them here
+                entry_future, entry_index, raw_future = future
+                entry = entry_future.result()[entry_index]
+                raw_tx = raw_future.result()
                 if entry is None:
                     utxos_being_doublespent.clear()
                     continue
@@ -254,75 +475,100 @@ def main():
                 # What we really want is the mempool entry's chunk feerate.
                 # And we actually don't want to track in-mempool utxos, only
                 # confirmed.
-                tx_rate_btc_kvb = Decimal(entry['fees']['ancestor']) / entry['ancestorsize'] * 1000
-                new_top_block = tx_rate_btc_kvb >= topblock_rate_btc_kvb 
+                ancestor_fee_sat = round(entry['fees']['ancestor'] * 100_000_000)
+                # fee/size*1000 >= rate, cross-multiplied to stay in ints
+                new_top_block = ancestor_fee_sat * 1000 >= topblock_rate_sat_kvb * entry['ancestorsize']
                 if new_top_block:
-                    raw_tx = getrawtransaction(txid)
                     # Might have already been evicted/mined/etc
                     if raw_tx is None:
                         utxos_being_doublespent.clear()
                         continue
-                    tx_bytes = bytes.fromhex(raw_tx["hex"])
+                    add_tx_prevouts = raw_tx.prevouts
 
                     # Cache tx to make sure we see it when it's being removed later
                     # FIXME get a better notification stream
                     dummy_cache[txid] = raw_tx
-                    dummy_cache_size += len(raw_tx["hex"]) / 2
-
-                    add_tx_prevouts = [(tx_input['txid'], tx_input['vout']) for tx_input in raw_tx["vin"]]
-
-                    for prevout in add_tx_prevouts:
-                        if prevout not in utxos_being_doublespent:
-                            # Bottom->Top, clear cached transaction if any
-                            if prevout in utxo_cache:
-                                logging.info(f"Deleting cache entry for {(tx_input['txid'], tx_input['vout'])}")
-                                deleted_prevouts = [(tx_input['txid'], tx_input['vout']) for tx_input in cycled_tx_cache[utxo_cache[prevout]]["vin"]]
-                                cycled_tx_cache_size -= len(cycled_tx_cache[utxo_cache[prevout]]["hex"]) / 2
-                                del cycled_tx_cache[utxo_cache[prevout]]
-                                del utxo_cache[prevout]
-                                for deleted_prevout in deleted_prevouts:
-                                    if deleted_prevout in cycled_input_set:
-                                        cycled_input_set.remove(deleted_prevout)
-                        else:
-                            # Top->Top, cache if entry is empty
-                            if prevout not in utxo_cache and utxo_cycled_count[prevout] >= CYCLE_THRESH:
-                                # Get replaced txid and full tx from dummy_cache
-                                removed_txid = utxos_being_doublespent[prevout]
-                                removed_tx = dummy_cache[removed_txid]
-                                removed_prevouts = [(tx_input['txid'], tx_input['vout']) for tx_input in raw_tx["vin"]]
+
+                    # Partition this tx's inputs against the pending
+                    # double-spends with C-level hash intersections
+                    # instead of per-prevout membership probes
+                    add_prevout_set = frozenset(add_tx_prevouts)
+                    respent_prevouts = utxos_being_doublespent.keys() & add_prevout_set
+
+                    # Bottom->Top, clear cached transactions if any.
+                    # Deletions run first so stale entries can't block
+                    # the caching pass below.
+                    for prevout in (add_prevout_set - respent_prevouts) & utxo_cache.keys():
+                        logging.info("Deleting cache entry for %s", prevout_str(prevout))
+                        # Bind once instead of re-probing the two
+                        # dicts for every access below
+                        cached_txid = utxo_cache.pop(prevout)
+                        deleted_tx = cycled_tx_cache.pop(cached_txid)
+                        for deleted_prevout in deleted_tx.prevouts:
+                            cycled_input_set.discard(deleted_prevout)
+
+                    for prevout in respent_prevouts:
+                        # Pop to detect remaining Top->Bottom later
+                        removed_txid = utxos_being_doublespent.pop(prevout)
+                        # Top->Top, cache if entry is empty
+                        if prevout not in utxo_cache and utxo_cycled_count.get_count(prevout) >= CYCLE_THRESH:
+                            # Get the full replaced tx from dummy_cache;
+                            # it may have been evicted in the meantime
+                            removed_tx = dummy_cache.get(removed_txid)
+                            if removed_tx is not None:
+                                # The removed tx's own inputs, parsed once
+                                # when it was fetched and cached alongside it
+                                removed_prevouts = removed_tx.prevouts
                                 can_cache = all(prevout not in cycled_input_set for prevout in removed_prevouts)
                                 if can_cache:
-                                    logging.info(f"{prevout} has been RBF'd, caching {removed_txid}")
+                                    logging.info("%s has been RBF'd, caching %s", prevout_str(prevout), removed_txid.hex())
                                     utxo_cache[prevout] = removed_txid
                                     cycled_tx_cache[removed_txid] = removed_tx
-                                    cycled_tx_cache_size += len(cycled_tx_cache[utxo_cache[prevout]]["hex"]) / 2
                                     for removed_prevout in removed_prevouts:
                                         cycled_input_set.add(removed_prevout)
                                 else:
-                                    logging.info(f"{removed_txid} is not being cached due to conflicts in input cache")
-                            del utxos_being_doublespent[prevout] # delete to detect remaining Top->Bottom later
+                                    logging.info("%s is not being cached due to conflicts in input cache", removed_txid.hex())
 
                     # Handle Top->Bottom: There are top block spends now unspent!
                     if len(utxos_being_doublespent) > 0:
                         # things were double-spent and not removed with top block
-                        for unspent_prevout, _ in utxos_being_doublespent.items():
+                        for unspent_prevout in utxos_being_doublespent:
                             # Count it first
-                            utxo_cycled_count[unspent_prevout] += 1
-                            logging.info(f"{unspent_prevout} has been cycled {utxo_cycled_count[unspent_prevout]} times")
-
-                            # If we have something cached, it might be free to re-enter now
-                            if unspent_prevout in utxo_cache and utxo_cache[unspent_prevout] in cycled_tx_cache:
-                                raw_tx = cycled_tx_cache[utxo_cache[unspent_prevout]]["hex"]
-                                send_ret = sendrawtransaction(raw_tx)
-                                if send_ret:
-                                    logging.info(f"Successfully resubmitted {send_ret}")
-                                    logging.info(f"rawhex: {raw_tx}")
+                            cycle_count = utxo_cycled_count.increment(unspent_prevout)
+                            logging.info("%s has been cycled %s times", prevout_str(unspent_prevout), cycle_count)
+
+                        # If we have something cached, it might be free to
+                        # re-enter now. Only prevouts that actually have a
+                        # cache assignment are worth probing, and the key-set
+                        # intersection is a single C-level operation rather
+                        # than a dict probe per pending prevout. Several
+                        # cycled prevouts can point at the same cached tx
+                        # (it has many inputs), so coalesce by txid and
+                        # send each tx once.
+                        to_send = {}
+                        for unspent_prevout in utxos_being_doublespent.keys() & utxo_cache.keys():
+                            cached_txid = utxo_cache[unspent_prevout]
+                            if cached_txid in to_send:
+                                continue
+                            cached_tx = cycled_tx_cache.get(cached_txid)
+                            if cached_tx is not None:
+                                cycled_tx_cache.touch(cached_txid)
+                                to_send[cached_txid] = cached_tx.tx_bytes.hex()
+
+                        # One round-trip for all resubmissions; per-tx
+                        # failures come back as None in the batch reply
+                        if to_send:
+                            send_rets = rpc_batch([("sendrawtransaction", [tx_hex]) for tx_hex in to_send.values()])
+                            resubmitted = [send_ret for send_ret in send_rets if send_ret]
+                            if resubmitted:
+                                logging.info("Successfully resubmitted %s", resubmitted)
 
                 # We processed the double-spends, clear
                 utxos_being_doublespent.clear()
 
-            elif label == "R":
-                logging.info(f"Tx {txid} removed")
+            elif label == LABEL_REMOVE:
+                if LOGGER.isEnabledFor(logging.INFO):
+                    logging.info("Tx %s removed", txid.hex())
                 # This tx is removed, perhaps replaced, next "A" message should be the tx replacing it(conflict_tx)
 
                 # If this tx is in the tx_cache, that implies it was top block
@@ -330,28 +576,26 @@ def main():
                 # the next "A"
                 # N.B. I am not sure at all the next "A" is actually a double-spend, that should be checked!
                 # I'm going off of functional tests.
-                if txid in dummy_cache:
-                    for tx_input in dummy_cache[txid]["vin"]:
-                        utxos_being_doublespent[(tx_input["txid"], tx_input["vout"])] = txid
-
-            elif label == "C" or label == "D":
-                logging.info(f"Block tip changed")
-                # FIXME do something smarter, for now we just hope this isn't hit on short timeframes
-                # Defender will have to resubmit enough again to be protected for the new period
-                if cycled_tx_cache_size > tx_cache_max_byte_size or dummy_cache_size >= tx_cache_max_byte_size:
-                    logging.info(f"wiping state")
-                    dummy_cache.clear()
-                    dummy_cache_size = 0
-                    utxo_cache.clear()
-                    utxo_cycled_count.clear()
-                    utxos_being_doublespent.clear()
-                    cycled_tx_cache.clear()
-                    cycled_tx_cache_size = 0
-                topblock_rate_btc_kvb = estimatesmartfee(3)["feerate"]
+                removed_entry = dummy_cache.get(txid)
+                if removed_entry is not None:
+                    dummy_cache.touch(txid)
+                    for prevout in removed_entry.prevouts:
+                        utxos_being_doublespent[prevout] = txid
+
+            elif label == LABEL_CONNECT or label == LABEL_DISCONNECT:
+                logging.info("Block tip changed")
+                # The LRU caches enforce the byte budget online, so no
+                # wholesale wipe is needed at block boundaries anymore;
+                # eviction purges dependent indexes incrementally.
+                # Refresh the threshold off-thread; a newer tip event
+                # simply supersedes any still-pending refresh.
+                rate_future = pool.submit(get_topblock_rate_sat_kvb, topblock_rate_sat_kvb)
     except KeyboardInterrupt:
         logging.info("Program interrupted by user")
     finally:
         # Clean up on exit
+        pool.shutdown(wait=False)
+        SESSION.close()
         socket.close()
         context.term()
         